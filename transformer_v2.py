@@ -10,9 +10,7 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 import math
-import copy
 import io
-from torch.autograd import Variable
 
 class PositionalEncoding(nn.Module):
 	'''
@@ -24,116 +22,196 @@ class PositionalEncoding(nn.Module):
 	def __init__(self,window,d_model):
 		super().__init__()
 
-		pe = torch.zeros(window, d_model)
-		for pos in range(window):
-			for i in range(0, d_model, 2):
-			  pe[pos, i] = math.sin(pos / (10000 ** ((2 * i)/d_model)))
-				
-			for i in range(1, d_model, 2):
-			  pe[pos, i] = math.cos(pos / (10000 ** ((2 * (i + 1))/d_model)))             
-				
+		pe = torch.zeros(window, d_model, dtype = torch.float32)
+		position = torch.arange(window).unsqueeze(1).float()
+		div_term = torch.exp(torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
+		pe[:, 0::2] = torch.sin(position * div_term)
+		# For odd d_model there is one fewer cosine column than sine column.
+		pe[:, 1::2] = torch.cos(position * div_term[:d_model // 2])
+
 		pe = pe.unsqueeze(0)
-		self.register_buffer('pe', pe)
+		# Built in fp32 and cast to the input dtype on use. Module-wide dtype casts
+		# (.double(), .half(), ...) convert this buffer like any other, so it is only
+		# fp32 as long as the module is. It is a constant sinusoid, so it is rebuilt on
+		# construction rather than stored in the state dict.
+		self.register_buffer('pe', pe, persistent = False)
 	
 	def forward(self, x):
 		seq_len = x.size(1)
-		x = x + Variable(self.pe[:,:seq_len],requires_grad=False)
+		if seq_len == self.pe.size(1):
+			# The encoder input always spans the whole window; skip the slice.
+			return x + self.pe.to(x.dtype)
+		x = x + self.pe[:, :seq_len].to(x.dtype)
 		return x
 
 def create_mask(x, y):
 	'''Create masks to be used in the decoder.
 	First has dimension [1,prediction_window,prediction_window]
 	Second has dimension [1,prediction_window,context_window]
+	The mask is boolean and True where attention is allowed.
 	'''
-	nopeak_mask = np.triu(np.ones((1,x+1,y+1)),k=1).astype('uint8')
-	peak = torch.from_numpy(nopeak_mask)
-	nopeak = peak[:,:-1,1:]
-	peak_mask = nopeak.transpose(1,2)
-	peak_mask = Variable(peak_mask)
-	return peak_mask
-
-def get_clones(module, N):
-	'''
-	This helper function is used to create copies of encoder and decoder layers.
-	These copies of encoder/decoder layers are used to construct the
-	complete stacked encoder/decoder modules.
-	'''
-	return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
+	return torch.triu(torch.ones(1, y, x, dtype = torch.bool), diagonal = 1).logical_not()
 
-def scaled_dot_product_attention(k, q, v, mask = None):
+def scaled_dot_product_attention(q, k, v, heads, mask = None):
 	'''
-	k : (batch, seq_len_k, heads, d_model)
-	q : (batch, seq_len_q, heads, d_model)
-	v : (batch, seq_len_v, heads, d_model)
+	q : (batch * heads, seq_len_q, d_model)
+	k : (batch * heads, seq_len_k, d_model)
+	v : (batch * heads, seq_len_v, d_model)
+	mask : boolean (1, 1, seq_len_q, seq_len_k), True where attention is allowed
+	Returns (batch * heads, seq_len_q, d_model).
+	q, k and v are contiguous when heads > 1. With a single head they may be strided
+	views into the fused projection (unit stride only along d_model), which bmm,
+	baddbmm and the fused kernels all accept without a copy.
 	'''
 
-	b, _, h, d = k.shape
+	bh, sq, d = q.shape
 
-	k = k.transpose(1, 2).contiguous().view(b * h, -1, d)
-	q = q.transpose(1, 2).contiguous().view(b * h, -1, d)
-	v = v.transpose(1, 2).contiguous().view(b * h, -1, d)
-	
-	scores = torch.matmul(q, k.transpose(1, 2))
-	if mask is not None:
-		scores = scores.masked_fill(mask == 0, -1e9)
-	scores = F.softmax(scores,dim=2)
-
-	# Scaled dot-product.
-	scores = torch.matmul(scores, v).view(b, h, -1, d)
-	return scores.transpose(1, 2).contiguous().view(b, -1, h * d)
+	if q.device.type == 'cpu':
+		# Manual fallback: the scaling and the mask (as an additive bias) are
+		# folded into a single batched GEMM for the scores.
+		if mask is None:
+			bias = torch.empty(1, 1, 1, dtype = q.dtype, device = q.device)
+			beta = 0
+		else:
+			# -finfo.max rather than -inf/-1e9 so the bias is finite in any dtype.
+			bias = torch.full((sq, k.size(1)), -torch.finfo(q.dtype).max, dtype = q.dtype, device = q.device)
+			bias.masked_fill_(mask[0, 0], 0.)
+			beta = 1
+		# Keys stay (batch * heads, seq_len_k, d_model) so the contracted d_model is the
+		# innermost dim of both operands ('bqd,bkd->bqk'); the transpose is only a stride
+		# swap that BLAS reads as a transposed operand, never a copy.
+		scores = torch.baddbmm(bias, q, k.transpose(1, 2), beta = beta, alpha = 1 / math.sqrt(d))
+		scores = F.softmax(scores, dim = -1)
+		return torch.bmm(scores, v)
+
+	# The fused kernels want 4D (batch, heads, seq_len, d_model) inputs. These views
+	# never copy: contiguous inputs split cleanly, and for the strided single-head
+	# inputs they only insert a size-1 heads dim.
+	q = q.view(-1, heads, sq, d)
+	k = k.view(-1, heads, k.size(1), d)
+	v = v.view(-1, heads, v.size(1), d)
+	scores = F.scaled_dot_product_attention(q, k, v, attn_mask = mask, dropout_p = 0., is_causal = False)
+	# The output need not be contiguous (the memory-efficient kernel returns a
+	# transposed (batch, seq_len, heads, d_model) buffer), so reshape rather than view.
+	return scores.reshape(bh, sq, d)
 
 class MultiHeadAttention(nn.Module):
 	'''This is a Mult-Head wide self-attention class.'''
 	def __init__(self, heads, d_model, context_window, pred_window,
-		first = None, dropout = 0.1, mask = None):
+		first = None, dropout = 0.1, mask = None, cross = False):
 		super().__init__()
 		
 		self.h = heads
 		self.dropout = nn.Dropout(dropout)
-		self.mask = mask
+		# Cast to bool and shape as (1, 1, seq_len_q, seq_len_k) once here, ready to
+		# broadcast against the 4D scores; the buffer follows the module across .to(device) calls.
+		if mask is not None:
+			mask = mask.bool().view(1, 1, *mask.shape[-2:])
+		self.register_buffer('mask', mask, persistent = False)
 		self.d_model = d_model
 		self.pred_window = pred_window
 		self.context_window = context_window
 		self.first = first
+		self.cross = cross
 		
-		self.q_linear = nn.Linear(d_model, heads*d_model,bias=False)
-		self.v_linear = nn.Linear(d_model, heads*d_model,bias=False)
-		self.k_linear = nn.Linear(d_model, heads*d_model,bias=False)
-		  
+		if cross:
+			# Keys and values are projected by the caller and passed in as kv
+			# (see Decoder), so only the query projection lives here.
+			self.q_linear = nn.Linear(d_model, heads*d_model, bias=False)
+		else:
+			# Query, key and value projections stacked into one weight so that
+			# self-attention needs a single GEMM.
+			self.qkv_linear = nn.Linear(d_model, 3*heads*d_model, bias=False)
+
 		self.unifyheads = nn.Linear(heads*d_model, d_model)
 
-	def forward(self, q, k, v):
+	def split_heads(self, x, n):
+		'''
+		Split a (batch, seq_len, n * heads * d_model) projection into n tensors of
+		shape (batch * heads, seq_len, d_model), the layout bmm/baddbmm consume directly.
+		The results are contiguous, except with a single head (see below).
+		'''
+		if self.h == 1:
+			# A single head already has that layout, so no reordering is needed. The
+			# chunks are strided views into x, not contiguous copies.
+			return x.chunk(n, dim = -1)
 
-		b = q.shape[0]
+		b = x.size(0)
+		x = x.view(b, -1, n, self.h, self.d_model).permute(2, 0, 3, 1, 4)
+		return x.reshape(n, b * self.h, -1, self.d_model).unbind(0)
 
-		k = self.k_linear(k).view(b, -1, self.h, self.d_model)
-		q = self.q_linear(q).view(b, -1, self.h, self.d_model)
-		v = self.v_linear(v).view(b, -1, self.h, self.d_model)
+	def forward(self, q, k = None, v = None, kv = None):
+		'''
+		With cross = True, only q and kv are used: kv holds the already projected keys
+		and values, (batch, seq_len_k, 2 * heads * d_model). Otherwise q, k and v are
+		projected here and kv must not be given.
+		'''
 
-		output = scaled_dot_product_attention(k, q, v, mask = self.mask)
+		b = q.shape[0]
+		h, d = self.h, self.d_model
+
+		if self.cross:
+			if kv is None:
+				raise ValueError('cross-attention module needs pre-projected keys/values as kv')
+			q, = self.split_heads(self.q_linear(q), 1)
+			k, v = self.split_heads(kv, 2)
+		elif kv is not None:
+			raise ValueError('kv is only accepted by modules built with cross = True')
+		elif q is k and k is v:
+			q, k, v = self.split_heads(self.qkv_linear(q), 3)
+		else:
+			w_q, w_k, w_v = self.qkv_linear.weight.split(h * d)
+			q, = self.split_heads(F.linear(q, w_q), 1)
+			if k is v:
+				# Keys and values share one fused projection.
+				k, v = self.split_heads(F.linear(k, self.qkv_linear.weight[h * d:]), 2)
+			else:
+				k, = self.split_heads(F.linear(k, w_k), 1)
+				v, = self.split_heads(F.linear(v, w_v), 1)
+
+		output = scaled_dot_product_attention(q, k, v, h, mask = self.mask)
+
+		if h == 1:
+			# No heads to merge.
+			return self.unifyheads(output)
+
+		# Merging the heads costs one reordering copy; unifyheads is then a plain addmm.
+		output = output.view(b, h, -1, d).transpose(1, 2).reshape(b, -1, h * d)
 		output = self.unifyheads(output)
 
 		return output
 
 class FeedForward(nn.Module):
-	'''This is a pointwise feedforward network.'''
-	def __init__(self, d_model, dropout = 0.1):
+	'''
+	This is a pointwise feedforward network.
+	The hidden layer is ff_mult times wider than d_model.
+	'''
+	def __init__(self, d_model, dropout = 0.1, ff_mult = 4):
 		super().__init__()
 		
 		self.linear = nn.Sequential(
-			nn.Linear(d_model,10 * d_model),
+			nn.Linear(d_model,ff_mult * d_model),
 			nn.ReLU(),
 			nn.Dropout(dropout),
-			nn.Linear(10 * d_model,d_model)
+			nn.Linear(ff_mult * d_model,d_model)
 		)
 	
 	def forward(self, x):
 		x = self.linear(x)
 		return x 
 
+def residual_norm(x, sublayer_out, dropout, norm):
+	'''
+	Residual connection of a sub-layer followed by the pre-norm of the next one.
+	Kept free of Python branching so torch.compile can fuse the dropout, add and
+	LayerNorm into a single kernel. Returns the residual stream and its normed copy.
+	'''
+	x = x + dropout(sublayer_out)
+	return x, norm(x)
+
 class EncoderLayer(nn.Module):
 	'''Encoder layer class.'''
-	def __init__(self, heads, d_model, context_window, pred_window, dropout = 0.1):
+	def __init__(self, heads, d_model, context_window, pred_window, dropout = 0.1, ff_mult = 4):
 		super().__init__()
 
 		self.d_model = d_model
@@ -143,39 +221,34 @@ class EncoderLayer(nn.Module):
 		self.norm_2 = nn.LayerNorm(d_model)
 
 		self.attn = MultiHeadAttention(heads, d_model, context_window, pred_window, dropout = dropout)
-		self.ff = FeedForward(d_model)
+		self.ff = FeedForward(d_model, ff_mult = ff_mult)
 
 		self.dropout_1 = nn.Dropout(dropout)
 		self.dropout_2 = nn.Dropout(dropout)
 	
 	def forward(self,x):
 		x2 = self.norm_1(x)
-		x = x + self.dropout_1(self.attn(x2,x2,x2))
-		x2 = self.norm_2(x)
+		x, x2 = residual_norm(x, self.attn(x2,x2,x2), self.dropout_1, self.norm_2)
 		x = x + self.dropout_2(self.ff(x2))
 		return x
 
 class Encoder(nn.Module):
 	'''Stacked encoder class.'''
-	def __init__(self, N, pe_window, heads, d_model, context_window, pred_window, dropout):
+	def __init__(self, N, pe_window, heads, d_model, context_window, pred_window, dropout, ff_mult = 4):
 		super().__init__()
 
 		self.N = N
 		self.pe = PositionalEncoding(pe_window, d_model)
-		self.dynamiclayers = get_clones(EncoderLayer(heads, d_model, context_window, pred_window,
-			dropout = dropout), N)
+		self.dynamiclayers = nn.Sequential(*[EncoderLayer(heads, d_model, context_window, pred_window,
+			dropout = dropout, ff_mult = ff_mult) for _ in range(N)])
 		self.norm = nn.LayerNorm(d_model)
 
 	def forward(self,x):
-		x = self.pe(x)
-
-		for i in range(self.N):
-		  x = self.dynamiclayers[i](x)
-		return self.norm(x)
+		return self.norm(self.dynamiclayers(self.pe(x)))
 
 class DecoderLayer(nn.Module):
 	'''Decoder Layer class'''
-	def __init__(self, heads, d_model, context_window, pred_window, first_mask, dropout = 0.1):
+	def __init__(self, heads, d_model, context_window, pred_window, first_mask, dropout = 0.1, ff_mult = 4):
 		super().__init__()
 
 		self.d_model = d_model
@@ -188,39 +261,47 @@ class DecoderLayer(nn.Module):
 		self.attn_1 = MultiHeadAttention(heads, d_model, context_window, pred_window,
 			dropout = dropout, mask = first_mask, first = False)
 		self.attn_2 = MultiHeadAttention(heads, d_model, context_window, pred_window,
-			dropout = dropout, first = False)
-		self.ff = FeedForward(d_model)
+			dropout = dropout, first = False, cross = True)
+		self.ff = FeedForward(d_model, ff_mult = ff_mult)
 
 		self.dropout_1 = nn.Dropout(dropout)
 		self.dropout_2 = nn.Dropout(dropout)
 		self.dropout_3 = nn.Dropout(dropout)
 
-	def forward(self, x, enc_out):
+	def forward(self, x, enc_kv):
+		'''
+		enc_kv : this layer's keys and values for attn_2, projected from the encoder
+		output by the owning Decoder, (batch, seq_len_k, 2 * heads * d_model).
+		'''
 	
 		x2 = self.norm_1(x)
-		x = x + self.dropout_1(self.attn_1(x2,x2,x2))
-		x2 = self.norm_2(x)
-		x = x + self.dropout_2(self.attn_2(x2,enc_out,enc_out))
-		x2 = self.norm_3(x)
+		x, x2 = residual_norm(x, self.attn_1(x2,x2,x2), self.dropout_1, self.norm_2)
+		x, x2 = residual_norm(x, self.attn_2(x2, kv = enc_kv), self.dropout_2, self.norm_3)
 		x = x + self.dropout_3(self.ff(x2))
 		return x
 
 class Decoder(nn.Module):
 	'''Stacked Decoder layer.'''
-	def __init__(self, N, pe_window, heads, d_model, context_window, pred_window, first_mask, dropout = 0.1):
+	def __init__(self, N, pe_window, heads, d_model, context_window, pred_window, first_mask, dropout = 0.1,
+		ff_mult = 4):
 		super().__init__()
 
 		self.N = N
 		self.pe = PositionalEncoding(pe_window, d_model)
-		self.decoderlayers = get_clones(DecoderLayer(heads, d_model, context_window,
-			pred_window, first_mask, dropout = dropout), N)
+		self.decoderlayers = nn.ModuleList([DecoderLayer(heads, d_model, context_window,
+			pred_window, first_mask, dropout = dropout, ff_mult = ff_mult) for _ in range(N)])
+		# The cross-attention keys/values depend only on enc_out, so the projections
+		# of all N layers are held as one weight and applied with a single GEMM.
+		self.kv_linear = nn.Linear(d_model, N * 2 * heads * d_model, bias = False)
 		self.norm = nn.LayerNorm(d_model)
 
 	def forward(self,x,enc_out):
 		x = self.pe(x)
 
-		for i in range(self.N):
-			x = self.decoderlayers[i](x,enc_out)
+		enc_kv = self.kv_linear(enc_out).chunk(self.N, dim = -1)
+
+		for layer, kv in zip(self.decoderlayers, enc_kv):
+			x = layer(x,kv)
 		return self.norm(x)
 
 class Ml4fTransformer(nn.Module):
@@ -236,16 +317,18 @@ class Ml4fTransformer(nn.Module):
 	and then passed on to the loss function.
 	'''
 	def __init__(self, experiment = 'return', d_model_e = 5, d_model_d = 1,
-		N = 2, heads = 4, first_mask = create_mask(5, 5), dropout = 0.1,
-		context_window = 15, pred_window = 5, pe_window = 15):
+		N = 2, heads = 4, first_mask = None, dropout = 0.1,
+		context_window = 15, pred_window = 5, pe_window = 15, ff_mult = 4):
 		super().__init__()
 		
 		self.d_model_d = d_model_d
 		self.d_model_e = d_model_e
 		self.context_window = context_window
 		self.pred_window = pred_window
+		if first_mask is None:
+			first_mask = create_mask(pred_window, pred_window)
 		self.dynamicencode = Encoder(N, pe_window, heads, d_model_e,
-			context_window, pred_window, dropout = dropout)
+			context_window, pred_window, dropout = dropout, ff_mult = ff_mult)
 
 		self.learn = nn.Sequential(
 			nn.Linear(context_window * d_model_e, pred_window * d_model_d),
@@ -254,7 +337,7 @@ class Ml4fTransformer(nn.Module):
 			)
 		
 		self.decoder = Decoder(N, pe_window, heads, d_model_d, context_window, pred_window,
-			first_mask, dropout = dropout)
+			first_mask, dropout = dropout, ff_mult = ff_mult)
 		
 		if experiment == 'return':
 			self.map = nn.Sequential(
@@ -278,9 +361,8 @@ class Ml4fTransformer(nn.Module):
 
 		b = x.size(0)
 		enc_output = self.dynamicencode(x) # (batch, ctx_window, d_e)
-		enc_output = enc_output.view(b,-1) # (batch, ctx_window)
-		enc_map = self.learn(enc_output) # (batch, pred_window * d_d)
-		enc_map = enc_map.view(-1, self.pred_window, self.d_model_d) # (batch, pred_window, d_d)
+		# flatten/unflatten are views: (batch, ctx_window * d_e) -> (batch, pred_window, d_d)
+		enc_map = self.learn(enc_output.flatten(1)).unflatten(1, (self.pred_window, self.d_model_d))
 		dec_output = self.decoder(y, enc_map) # (batch, pred_window, d_d)
 
 		dec_output = dec_output.view(b, self.pred_window)
@@ -290,14 +372,19 @@ class Ml4fTransformer(nn.Module):
 
 if __name__ == '__main__':
 
+	device = 'cuda' if torch.cuda.is_available() else 'cpu'
 	mask = create_mask(5, 5)
 
+	# fp32 weights; the forward pass runs in bf16 under autocast below.
 	model = Ml4fTransformer(experiment = 'return',
 		d_model_e = 5, d_model_d = 1, heads = 4, N = 4, first_mask = mask,
-		dropout = 0.1, context_window = 15, pred_window = 5, pe_window = 15).double()
-
-	x = torch.randn(4, 15, 5)
-	y = torch.randn(4, 5, 1)
+		dropout = 0.1, context_window = 15, pred_window = 5, pe_window = 15).to(device)
+	# Shapes are fixed, so compile once for static shapes; on CUDA the
+	# reduce-overhead mode also replays the step as a CUDA graph.
+	model = torch.compile(model, dynamic = False, mode = 'reduce-overhead', fullgraph = True)
 
-	print(model(x, y))
+	x = torch.randn(4, 15, 5, device = device)
+	y = torch.randn(4, 5, 1, device = device)
 
+	with torch.no_grad(), torch.autocast(device, dtype = torch.bfloat16):
+		print(model(x, y))